@@ -1,3 +1,5 @@
+import functools
+
 from enum import Enum, auto, unique
 
 from gi.repository import Gdk
@@ -11,7 +13,7 @@ from gi.repository import Gdk
 #   232 - 255   24 step grayscale
 #
 # For a description of the sections and their meaning
-# as well as color values see the comment in Color.to_gdk()
+# as well as color values see the comment in Color.to_rgba_tuple()
 EXTENDED_COLOR_BRIGHT_LOWER = 8
 EXTENDED_COLOR_CUBE_LOWER = 16
 EXTENDED_COLOR_GRAYSCALE_LOWER = 232
@@ -65,14 +67,20 @@ def extended_color_val(x):
     val = x * 40 + 55 if x > 0 else 0
     return val / 255
 
-def int_triple_to_rgba(c):
+# (r, g, b) channel values of the 6 * 6 * 6 color cube indexed
+# by n - EXTENDED_COLOR_CUBE_LOWER, see Color.to_rgba_tuple().
+EXTENDED_COLOR_CUBE = tuple(
+    (r, g, b)
+    for r in map(extended_color_val, range(6))
+    for g in map(extended_color_val, range(6))
+    for b in map(extended_color_val, range(6))
+)
+
+def rgba_to_tuple(rgba):
     """
-    Convert a triple of the form (r, g, b) into
-    a valid Gdk.RGBA where r, g and b are integers
-    in the range [0;255].
+    Convert a Gdk.RGBA into a (red, green, blue, alpha) tuple.
     """
-    (r, g, b) = tuple(map(lambda x: x / 255, c))
-    return Gdk.RGBA(r, g, b, 1)
+    return (rgba.red, rgba.green, rgba.blue, rgba.alpha)
 
 def basic_color_to_rgba(n, bright=False):
     """
@@ -135,28 +143,34 @@ class Color(object):
     def __eq__(self, other):
         return self.type == other.type and self.data == other.data
 
-    def to_gdk(self):
+    # Colors are hashable by value, conversions are thus memoized.
+    # Contrary to Gdk.RGBA objects the returned tuples are immutable.
+    @functools.lru_cache(maxsize=512)
+    def to_rgba_tuple(self):
         """
-        Convert a Color into a Gdk.RGBA which TextTag accepts.
-        The color scheme for the 16 color part uses default X11
-        colors and is currently not configurable.
+        Convert a Color into a (red, green, blue, alpha) tuple of
+        floats in the range [0;1]. The color scheme for the 16 color
+        part uses default X11 colors and is currently not configurable.
         """
         if self.type is ColorType.NUMBERED_8:
-            return basic_color_to_rgba(self.data, bright=False)
+            return rgba_to_tuple(basic_color_to_rgba(self.data, bright=False))
         elif self.type is ColorType.NUMBERED_8_BRIGHT:
-            return basic_color_to_rgba(self.data, bright=True)
+            return rgba_to_tuple(basic_color_to_rgba(self.data, bright=True))
         elif self.type is ColorType.TRUECOLOR:
-            return int_triple_to_rgba(self.data)
+            (r, g, b) = tuple(map(lambda x: x / 255, self.data))
+            return (r, g, b, 1.0)
         elif self.type is ColorType.NUMBERED_256:
             if self.data < EXTENDED_COLOR_BRIGHT_LOWER:
                 # normal 8 colors
-                return basic_color_to_rgba(BasicColor(self.data), bright=False)
+                return rgba_to_tuple(
+                    basic_color_to_rgba(BasicColor(self.data), bright=False)
+                )
             elif self.data < EXTENDED_COLOR_CUBE_LOWER:
                 # bright 8 colors
-                return basic_color_to_rgba(
+                return rgba_to_tuple(basic_color_to_rgba(
                     BasicColor(self.data - EXTENDED_COLOR_BRIGHT_LOWER),
                     bright=True
-                )
+                ))
             elif self.data < EXTENDED_COLOR_GRAYSCALE_LOWER:
                 # color cube which is constructed in the following manner:
                 #
@@ -170,13 +184,18 @@ class Color(object):
                 # This is not documented anywhere as far as I am aware.
                 # The information presented here has been reverse engineered
                 # from XTerm's 256colres.pl.
-                tmp = self.data - EXTENDED_COLOR_CUBE_LOWER
-                (r, tmp) = divmod(tmp, 6 * 6)
-                (g, b) = divmod(tmp, 6)
-
-                triple = tuple(map(extended_color_val, (r, g, b)))
-                return Gdk.RGBA(*triple)
+                #
+                # The channel values are precomputed in EXTENDED_COLOR_CUBE.
+                triple = EXTENDED_COLOR_CUBE[self.data - EXTENDED_COLOR_CUBE_LOWER]
+                return triple + (1.0,)
             else:
                 # grayscale in 24 steps
                 c = (self.data - EXTENDED_COLOR_GRAYSCALE_LOWER) * (1.0/24)
-                return Gdk.RGBA(c, c, c, 1.0)
+                return (c, c, c, 1.0)
+
+    def to_gdk(self):
+        """
+        Convert a Color into a Gdk.RGBA which TextTag accepts,
+        see to_rgba_tuple() for the used color values.
+        """
+        return Gdk.RGBA(*self.to_rgba_tuple())
@@ -32,7 +32,7 @@ class TabComp():
             self._tabcomp_matches = None
             self._tabcomp_index = 0
 
-            end = buffer.get_iter_at_offset(buffer.props.cursor_position)
+            end = buffer.get_iter_at_mark(buffer.get_insert())
             self._tabcomp_mark = buffer.create_mark(None, end, True)
         else:
             end = buffer.get_iter_at_mark(self._tabcomp_mark)
@@ -48,7 +48,7 @@ class TabComp():
         # Insert the matched completion text and delete
         # text potentially remaining from older completion.
         buffer.insert(end, c)
-        cursor = buffer.get_iter_at_offset(buffer.props.cursor_position)
+        cursor = buffer.get_iter_at_mark(buffer.get_insert())
         buffer.delete(end, cursor)
 
         # Advance current index in matches and wrap-around.
@@ -37,19 +37,36 @@ class History():
 
         self.__cur.execute(self.__schema)
 
+        # Entries added since the last commit()
+        self.__pending = []
+
     def close(self):
+        self.commit()
         self.__con.close()
 
     def add_entry(self, fd, entry):
+        """Add an entry for the executable currently running on the
+           given file descriptor. The entry is not written to the
+           database until commit() is called."""
         entry = entry.rstrip('\n')
         if len(entry) == 0:
             return
         exe = self.__get_exec(fd)
 
-        # Insert new entry into table and make sure the **total** amount
+        self.__pending.append((exe, entry))
+
+    def commit(self):
+        """Write all pending entries to the database in a single
+           transaction."""
+        if not self.__pending:
+            return
+
+        # Insert new entries into table and make sure the **total** amount
         # of entries in the entire table does not exceed self.histsize.
         # If this value is exceeded, remove the first (i.e. oldest) entries.
-        self.__cur.execute("INSERT INTO history VALUES (?, ?)", (exe, entry))
+        self.__cur.executemany("INSERT INTO history VALUES (?, ?)", self.__pending)
+        self.__pending = []
+
         self.__cur.execute("""
                 DELETE FROM history WHERE ( SELECT count(*) FROM history ) > :max
                     AND rowid IN (
@@ -69,6 +86,7 @@ class History():
         if (offset < 0):
             return None
 
+        self.commit()
         exe = self.__get_exec(fd)
 
         # Select an entry by the given offset. If the offset exceeds the
@@ -10,9 +10,15 @@ CTRL = {
     "<ctrl>d": termios.VEOF,
 }
 
+# Bindings for the control keys, included in the stylesheet below
+CTRL_BINDINGS = "".join(F'bind "{key}" {{ "termios-ctrlkey" ({idx}) }};\n'
+        for key, idx in CTRL.items()).encode()
+
 class Bindings():
     stylesheet = b"""
         @binding-set saneterm-key-bindings {
+            %s
+
             bind "<ctrl>u" { "kill-after-output" () };
             bind "<ctrl>a" { "move-input-start" () };
             bind "<ctrl>e" { "move-input-end" () };
@@ -40,23 +46,16 @@ class Bindings():
         * {
              -gtk-key-bindings: saneterm-key-bindings;
         }
-    """
+    """ % CTRL_BINDINGS
+
+    # The stylesheet is only parsed once and shared by all widgets.
+    provider = None
 
     def __init__(self, widget):
-        self.provider = Gtk.CssProvider()
-        self.provider.load_from_data(self.stylesheet)
+        if Bindings.provider is None:
+            Bindings.provider = Gtk.CssProvider()
+            Bindings.provider.load_from_data(self.stylesheet)
 
         style_ctx = widget.get_style_context()
         style_ctx.add_provider(self.provider,
                 Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
-
-    def add_bind(self, key, signal, arg):
-        bindings = self.__binding_set()
-        # Using Gtk.BindingEntry.add_signall() would be preferable
-        # https://gitlab.gnome.org/GNOME/pygobject/-/issues/474
-        Gtk.BindingEntry().add_signal_from_string(bindings,
-                F'bind "{key}" {{ "{signal}" ({arg}) }};')
-
-    def __binding_set(self):
-        return Gtk.BindingSet.find("saneterm-key-bindings")
-
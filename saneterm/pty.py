@@ -1,5 +1,7 @@
 import os
 import re
+import select
+import termios
 
 from pty import fork
 from .color import Color, ColorType, BasicColor
@@ -8,38 +10,197 @@ from gi.repository import GLib, Pango
 
 TERM = "dumb"
 
-class Source(GLib.Source):
+# conditions on the PTY master the callback is dispatched for
+EVENTS = GLib.IOCondition.IN|GLib.IOCondition.HUP
+
+class Source(object):
+    """
+    Runs a command on a new PTY and dispatches a callback whenever
+    output is available on the PTY master or the child hung up.
+    """
     master = -1
 
     def __init__(self, cmd):
-        GLib.Source.__init__(self)
         self.cmd = cmd
-        self.tag = None
+        self.cc = None
+        # buffers which have not been written to the master yet
+        self.writes = []
 
-    def prepare(self):
-        if self.master != -1:
-            return False, -1
+    def attach(self, callback, priority=GLib.PRIORITY_DEFAULT):
+        """
+        Spawn the command on the first main loop iteration and invoke
+        callback(master, condition) with the given priority afterwards.
+        """
+        GLib.idle_add(self.spawn, callback, priority,
+                priority=GLib.PRIORITY_HIGH)
 
+    def spawn(self, callback, priority):
         pid, self.master = fork()
         if pid == 0:
             # Terminal options enforced by saneterm.
             # Most importantly, local echo is disabled. Instead we show
             # characters on input directly in the GTK termview/TextBuffer.
-            os.system("stty -onlcr -echo")
+            # Equivalent to stty(1) -onlcr -echo without spawning a shell.
+            attrs = termios.tcgetattr(0)
+            attrs[1] &= ~termios.ONLCR # oflag
+            attrs[3] &= ~termios.ECHO  # lflag
+            termios.tcsetattr(0, termios.TCSANOW, attrs)
 
             os.environ["TERM"] = TERM
             os.execvp(self.cmd[0], self.cmd)
 
-        events = GLib.IOCondition.IN|GLib.IOCondition.HUP
-        self.tag = self.add_unix_fd(self.master, events)
+        # Reads are performed non-blocking in order to drain
+        # all available output from the PTY on each wakeup.
+        os.set_blocking(self.master, False)
+
+        # Contrary to a GLib.Source implemented in Python, a file
+        # descriptor source doesn't call into Python on every main
+        # loop iteration but only when the callback is dispatched.
+        GLib.unix_fd_add_full(priority, self.master, EVENTS, callback)
+
+        return GLib.SOURCE_REMOVE
+
+    def control_chars(self):
+        # The termios(3) control characters are cached until
+        # invalidate_cc() is called, i.e. until the child may
+        # have changed its terminal settings.
+        if self.cc is None:
+            self.cc = termios.tcgetattr(self.master)[-1]
 
-        return False, -1
+        return self.cc
 
-    def check(self):
-        return False
+    def invalidate_cc(self):
+        self.cc = None
 
-    def dispatch(self, callback, args):
-        return callback(self, self.tag, self.master)
+    def write(self, data):
+        # Writes are queued and performed at once using writev(2)
+        # on the next main loop iteration, see flush_writes().
+        if not data:
+            return
+        elif not self.writes:
+            GLib.idle_add(self.flush_writes, priority=GLib.PRIORITY_DEFAULT)
+
+        self.writes.append(data)
+
+    def flush_writes(self):
+        # The master is non-blocking (see spawn), hence we need to
+        # wait explicitly until the child consumed all of our input.
+        while self.writes:
+            try:
+                n = os.writev(self.master, self.writes)
+            except BlockingIOError:
+                select.select([], [self.master], [])
+                continue
+
+            # Remove written buffers, keep the rest of partial writes.
+            while n > 0:
+                data = self.writes[0]
+                if n < len(data):
+                    self.writes[0] = data[n:]
+                    break
+
+                n -= len(data)
+                self.writes.pop(0)
+
+        return GLib.SOURCE_REMOVE
+
+def utf8_sequence_length(b):
+    """
+    Return the length of the UTF-8 sequence started by the given
+    byte or 0 if the byte doesn't start a multi-byte sequence.
+    """
+    if b >= 0xf0 and b <= 0xf4:
+        return 4
+    elif b >= 0xe0 and b <= 0xef:
+        return 3
+    elif b >= 0xc2 and b <= 0xdf:
+        return 2
+    else:
+        return 0
+
+def utf8_valid_prefix(seq):
+    """
+    Check whether the given incomplete multi-byte sequence, i.e. a
+    start byte followed by continuation bytes, can still be completed
+    to a valid UTF-8 sequence. Only the second byte has a restricted
+    range (to exclude overlong encodings, surrogates and code points
+    beyond U+10FFFF), see RFC 3629 Section 4.
+    """
+    if len(seq) < 2:
+        return True
+
+    lead, b = seq[0], seq[1]
+    if lead == 0xe0:
+        return b >= 0xa0 and b <= 0xbf
+    elif lead == 0xed:
+        return b >= 0x80 and b <= 0x9f
+    elif lead == 0xf0:
+        return b >= 0x90 and b <= 0xbf
+    elif lead == 0xf4:
+        return b >= 0x80 and b <= 0x8f
+    else:
+        return b >= 0x80 and b <= 0xbf
+
+class Decoder(object):
+    """
+    Incremental UTF-8 decoder for output read from a pty device.
+    Instead of employing a (comparatively slow) incremental decoder
+    from the codecs module, an incomplete multi-byte sequence at the
+    end of the input is retained and the remaining input is decoded
+    at once. Invalid input is decoded using replacement characters.
+    """
+    __slots__ = ('__tail',)
+
+    def __init__(self):
+        # incomplete multi-byte sequence from the last call
+        self.__tail = b''
+
+    def decode(self, data):
+        """
+        Decode the given bytes or bytearray object and return the
+        decoded string. Incomplete multi-byte sequences at the end of
+        the input are retained and prepended to the next call's input.
+        """
+        # Output of most programs is pure ASCII, which can be detected
+        # cheaply and never requires any decoder state.
+        if not self.__tail and data.isascii():
+            return str(data, 'ascii')
+
+        prefix = ''
+        if self.__tail:
+            tail, self.__tail = self.__tail, b''
+
+            # Complete the retained sequence using the first bytes of
+            # the input to avoid copying the entire input. If that is
+            # not possible, e.g. due to invalid input, fall back to
+            # decoding the concatenation of both.
+            n = utf8_sequence_length(tail[0]) - len(tail)
+            try:
+                prefix = str(tail + bytes(data[:n]), 'UTF-8')
+                data = memoryview(data)[n:]
+            except UnicodeDecodeError:
+                data = tail + data
+
+        # Most reads end with an ASCII character, in which case
+        # there is no incomplete sequence which must be retained.
+        if data and data[-1] < 0x80:
+            return prefix + str(data, 'UTF-8', 'replace')
+
+        # Find the start of the last sequence, which is at most three
+        # bytes away from the end, and check whether it is complete.
+        # Invalid incomplete sequences are not retained, they are
+        # decoded using replacement characters right away instead.
+        end = len(data)
+        for idx in range(end - 1, max(end - 4, -1), -1):
+            b = data[idx]
+            if b < 0x80 or b >= 0xc0:
+                if end - idx < utf8_sequence_length(b) and \
+                        utf8_valid_prefix(data[idx:end]):
+                    self.__tail = bytes(data[idx:])
+                    end = idx
+                break
+
+        return prefix + str(memoryview(data)[:end], 'UTF-8', 'replace')
 
 class EventType(Enum):
     TEXT = auto()
@@ -109,13 +270,24 @@ class PositionedIterator(object):
     * pos: the index of the last element received via __next__()
     * wrapped: the string used for construction
     """
+    __slots__ = ('pos', 'wrapped', '_waypoints', '_n')
+
     def __init__(self, s):
+        self._waypoints = []
+        self.reset(s)
+
+    def reset(self, s):
+        """
+        Reset the iterator to the start of the given string,
+        allowing a single iterator to be reused for many strings.
+        """
         # always points to the position of the element
         # just received via __next__()
         self.pos = -1
         self.wrapped = s
+        self._n = len(s)
 
-        self.waypoints = []
+        self._waypoints.clear()
 
     def waypoint(self):
         """
@@ -152,11 +324,11 @@ class PositionedIterator(object):
                 ignore_colon = True
         """
         # TODO: maybe don't support calling waypoint if pos == -1
-        self.waypoints.append(max(self.pos - 1, -1))
+        self._waypoints.append(max(self.pos - 1, -1))
 
     def backtrack(self):
         """See documentation of waypoint()"""
-        self.pos = self.waypoints.pop()
+        self.pos = self._waypoints.pop()
 
     def next(self):
         """Shortcut for __next__()"""
@@ -167,11 +339,14 @@ class PositionedIterator(object):
         Consume n elements of the iterator and return them as a string slice.
         """
         start = self.pos + 1
+        end = start + n
 
-        for _ in range(n):
-            _ = self.__next__()
+        if end > self._n:
+            # consume remaining elements, like repeated __next__() calls
+            self.pos = self._n - 1
+            raise StopIteration
 
-        end = self.pos + 1
+        self.pos = end - 1
 
         return self.wrapped[start:end]
 
@@ -193,36 +368,81 @@ class PositionedIterator(object):
 
         (In a real example you'd also consume the semicolon)
         """
-        x = self.__next__()
-        start = self.pos
+        # Scan using local variables instead of repeatedly invoking
+        # __next__(), which requires multiple attribute accesses.
+        wrapped = self.wrapped
+        n = self._n
+        start = self.pos + 1
 
-        while f(x):
-            x = self.__next__()
+        end = start
+        while end < n and f(wrapped[end]):
+            end += 1
 
-        end = self.pos
-        self.pos -= 1
+        if end == n:
+            self.pos = n - 1
+            raise StopIteration
 
-        return self.wrapped[start:end]
+        self.pos = end - 1
+
+        return wrapped[start:end]
+
+    def take_until(self, stop_chars):
+        """
+        Consume elements up to, but not including, the next occurrence
+        of any of the given characters and return them as a string
+        slice. This is equivalent to takewhile_greedy() with the
+        predicate lambda x: x not in stop_chars, including the
+        StopIteration condition, but searches using str.find().
+        """
+        wrapped = self.wrapped
+        start = self.pos + 1
+
+        found = [i for i in (wrapped.find(c, start) for c in stop_chars) if i >= 0]
+        if not found:
+            self.pos = self._n - 1
+            raise StopIteration
+
+        end = min(found)
+        self.pos = end - 1
+
+        return wrapped[start:end]
+
+    def skip_until(self, pattern):
+        """
+        Consume elements up to, but not including, the start of the
+        next match of the given compiled regular expression. If there
+        is no further match, all remaining elements are consumed.
+        """
+        m = pattern.search(self.wrapped, self.pos + 1)
+        end = m.start() if m else self._n
+
+        self.pos = end - 1
 
     def empty(self):
         """
         Check if the iterator has no elements left
         without consuming the next item (if any).
         """
-        return self.pos + 1 == len(self.wrapped)
+        return self.pos + 1 == self._n
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        self.pos += 1
-
-        try:
-            return self.wrapped[self.pos]
-        except IndexError:
-            self.pos -= 1
+        pos = self.pos + 1
+        if pos == self._n:
             raise StopIteration
 
+        self.pos = pos
+        return self.wrapped[pos]
+
+# control characters which are handled by the Parser
+CONTROL_CHARS = re.compile('[\a\033]')
+
+# complete CSI sequence consisting of parameter bytes, intermediate
+# bytes and a final byte, see ECMA-48 (5th edition) Section 5.4.
+CSI_SEQUENCE = re.compile('\033\\[([\x30-\x3f]*)[\x20-\x2f]*([\x40-\x7e])')
+
 def csi_parameter_byte(c):
     """
     Check if the given unicode character is a CSI sequence
@@ -593,14 +813,18 @@ class Parser(object):
     which just need to be reflected in the UI while any state
     is tracked in the Parser object.
     """
+    __slots__ = ('__leftover', '__it')
+
     def __init__(self):
         # unparsed output left from the last call to parse
         self.__leftover = ''
+        # iterator reused for the input of each call to parse
+        self.__it = PositionedIterator('')
 
     def parse(self, input):
         """
         Main interface of Parser. Given a proper decoded
-        Python string , it yields a series of tuples of the
+        Python string, it returns a list of tuples of the
         form (EventType, payload) which the caller can
         iterate through. Valid events are:
 
@@ -620,9 +844,13 @@ class Parser(object):
         from saneterm's output in this way.
         """
 
-        it = PositionedIterator(self.__leftover + input)
+        it = self.__it
+        it.reset(self.__leftover + input)
         self.__leftover = ''
 
+        # events generated from the given input
+        events = []
+
         # keep track of the start position of the slice
         # we want to emit as a TEXT event
         start = 0
@@ -640,7 +868,7 @@ class Parser(object):
             # from start to flush_until will be emitted as
             # a TEXT event
             flush_until = None
-            # if not empty, each of its elements will be yield
+            # if not empty, each of its elements will be emitted
             # one by one, but only after any necessary flushing
             special_evs = []
 
@@ -665,7 +893,15 @@ class Parser(object):
                     it.waypoint()
 
                     try:
-                        if it.next() == '[':
+                        # Complete CSI sequences are matched at once, the
+                        # iterator is only used for incomplete or invalid
+                        # sequences as well as other escape sequences.
+                        m = CSI_SEQUENCE.match(it.wrapped, it.pos)
+                        if m is not None:
+                            it.pos = m.end() - 1
+                            if m.group(2) == 'm':
+                                parse_sgr_sequence(m.group(1), special_evs)
+                        elif it.next() == '[':
                             parse_csi_sequence(it, special_evs)
                         else:
                             # we only parse CSI sequences for now, all other
@@ -698,7 +934,11 @@ class Parser(object):
                     # TermView verbatim, we'll need to backtrack as well as well
                     if ignore_esc:
                         it.backtrack()
-
+            else:
+                # Ordinary characters are added to the buffer as is,
+                # so we can skip ahead to the next control character
+                # instead of inspecting every character separately.
+                it.skip_until(CONTROL_CHARS)
 
             # at the end of input, flush if we aren't already
             if flush_until == None and it.empty():
@@ -706,12 +946,13 @@ class Parser(object):
 
             # only generate text event if it is non empty, …
             if flush_until != None and flush_until > start:
-                yield (EventType.TEXT, it.wrapped[start:flush_until])
+                events.append((EventType.TEXT, it.wrapped[start:flush_until]))
 
             # … but advance as if we had flushed
             if flush_until != None:
                 start = it.pos + 1
 
             if len(special_evs) > 0:
-                for ev in special_evs:
-                    yield ev
+                events.extend(special_evs)
+
+        return events
@@ -1,13 +1,15 @@
 import sys
 import os
-import codecs
 import termios
 import fcntl
 import struct
+import time
+import errno
 
 from . import keys
 from . import proc
 from . import pty
+from .color import Color, ColorType, BasicColor
 from .search import SearchBar
 from .history import History
 from .termview import *
@@ -19,6 +21,18 @@ from gi.repository import Pango
 
 NAME = "saneterm"
 
+# Amount of bytes requested per read(2) from the PTY and upper bounds
+# for the amount of bytes and the time (in seconds) spent reading per
+# main loop iteration. Remaining output is read on the next iteration.
+READ_SIZE = 64 * 1024
+READ_LIMIT = 1024 * 1024
+READ_TIME = 0.01
+
+# struct winsize as expected by the TIOCSWINSZ ioctl
+WINSIZE = struct.Struct('HHHH')
+# Delay (in milliseconds) after which a new window size is set
+RESIZE_DELAY = 50
+
 class Terminal(Gtk.Window):
     config = {
         'autoscroll': True,
@@ -30,36 +44,46 @@ class Terminal(Gtk.Window):
         self.set_name(NAME)
 
         self.hist = History()
+        self.hist_commit_pending = False
         self.reset_history_index()
 
         self.pty = pty.Source(cmd)
-        self.pty.set_priority(GLib.PRIORITY_LOW)
-        self.pty.set_callback(self.handle_pty)
-        self.pty.attach(None)
+        self.pty.attach(self.handle_pty, GLib.PRIORITY_LOW)
+
+        # file name completion for the foreground process, see complete()
+        self.file_completion = None
 
         self.pty_parser = pty.Parser()
         # Gtk TextTags to use, generated from TEXT_STYLE events
-        self.active_text_tags = {}
+        self.reset_text_tags()
         # Already created TextTags which are reused to save on allocs
         self.cached_text_tags = {}
 
         self.termview = TermView(self.complete, limit)
+        GLib.idle_add(self.prewarm_text_tags, priority=GLib.PRIORITY_LOW)
+        self.autoscroll_pending = False
+        self.reset_cell_size()
+        # last window size set via TIOCSWINSZ and the size which
+        # should be set next, see update_size() and set_winsize()
+        self.winsize = None
+        self.pending_winsize = None
 
         # Block-wise reading from the PTY requires an incremental decoder.
-        self.decoder = codecs.getincrementaldecoder('UTF-8')()
+        self.decoder = pty.Decoder()
+        # Preallocated buffer used for reading from the PTY.
+        self.read_buffer = memoryview(bytearray(READ_SIZE))
 
         self.termview.connect("new-user-input", self.user_input)
         self.termview.connect("termios-ctrlkey", self.termios_ctrl)
-        self.termview.connect("size-allocate", self.autoscroll)
         self.termview.connect("populate-popup", self.populate_popup)
+        self.termview.connect("style-updated", self.reset_cell_size)
+        self.termview.connect("screen-changed", self.reset_cell_size)
 
         self.connect("configure-event", self.update_size)
         self.connect("destroy", self.destroy)
         self.connect_after("set-focus", self.focus)
 
-        bindings = keys.Bindings(self.termview)
-        for key, idx in keys.CTRL.items():
-            bindings.add_bind(key, "termios-ctrlkey", idx)
+        keys.Bindings(self.termview)
 
         vbox = Gtk.Box.new(Gtk.Orientation.VERTICAL, 0)
         self.add(vbox)
@@ -70,6 +94,12 @@ class Terminal(Gtk.Window):
         self.scroll = Gtk.ScrolledWindow().new(None, None)
         self.scroll.set_policy(Gtk.PolicyType.AUTOMATIC, Gtk.PolicyType.ALWAYS)
         self.scroll.add(self.termview)
+
+        # Only scroll if the content or the size of the view changed
+        # instead of on every size allocation of the TermView.
+        adj = self.scroll.get_vadjustment()
+        adj.connect("notify::upper", self.autoscroll)
+        adj.connect("notify::page-size", self.autoscroll)
         self.update_wrapmode()
         vbox.pack_start(self.scroll, True, True, 0)
 
@@ -77,27 +107,20 @@ class Terminal(Gtk.Window):
             vscroll = self.scroll.get_vscrollbar()
             vscroll.hide()
 
-        signals = {
-            "toggle-search": (),
-            "toggle-config": (GObject.TYPE_STRING,),
-            "history-entry": (GObject.TYPE_LONG,),
-        }
-
-        for name, args in signals.items():
-            GObject.signal_new(name, self.termview,
-                    GObject.SIGNAL_ACTION, GObject.TYPE_NONE,
-                    args)
-
         self.termview.connect("toggle-search", self.toggle_search, self.search_bar)
         self.termview.connect("toggle-config", self.toggle_config)
         self.termview.connect("history-entry", self.history)
 
     def complete(self, input):
-        # XXX: This could be cached as the CWD shouldn't
-        # change unless input is send to the child process.
-        cwd = proc.cwd(os.tcgetpgrp(self.pty.master))
-
-        f = completion.FileName(cwd)
+        # The CWD of the foreground process shouldn't change unless
+        # input is send to the child process. Hence, the completion
+        # is cached per process group and reset in user_input().
+        pgrp = os.tcgetpgrp(self.pty.master)
+        if self.file_completion is None or self.file_completion[0] != pgrp:
+            cwd = proc.cwd(pgrp)
+            self.file_completion = (pgrp, completion.FileName(cwd))
+
+        _, f = self.file_completion
         return f.get_matches(input)
 
     def focus(self, window, widget):
@@ -144,18 +167,46 @@ class Terminal(Gtk.Window):
         # font width/height as determined by the PangoLayout.
         width, height = widget.get_size()
 
-        ctx = self.termview.get_pango_context()
-        layout = Pango.Layout(ctx)
-        layout.set_markup(" ") # assumes monospace
-        fw, fh = layout.get_pixel_size()
+        fw, fh = self.get_cell_size()
 
         rows = int(height / fh)
         cols = int(width / fw)
 
         # TODO: use tcsetwinsize() instead of the ioctl.
         # See: https://github.com/python/cpython/pull/23686
-        ws = struct.pack('HHHH', rows, cols, width, height) # struct winsize
-        fcntl.ioctl(self.pty.master, termios.TIOCSWINSZ, ws)
+        ws = WINSIZE.pack(rows, cols, width, height)
+
+        # Resizing the window emits a large amount of configure-events,
+        # the ioctl is delayed to only set the latest size at most once
+        # per RESIZE_DELAY. Each ioctl causes a SIGWINCH for the child.
+        if self.pending_winsize is None:
+            GLib.timeout_add(RESIZE_DELAY, self.set_winsize)
+        self.pending_winsize = ws
+
+    def set_winsize(self):
+        ws, self.pending_winsize = self.pending_winsize, None
+
+        # configure-event is also emitted if the window is moved,
+        # only perform the ioctl if the window size actually changed.
+        if ws != self.winsize:
+            fcntl.ioctl(self.pty.master, termios.TIOCSWINSZ, ws)
+            self.winsize = ws
+
+        return GLib.SOURCE_REMOVE
+
+    def get_cell_size(self):
+        # The font (and thus the cell size) only changes if the style
+        # or the screen of the TermView changes, hence it is cached.
+        if self.cell_size is None:
+            ctx = self.termview.get_pango_context()
+            layout = Pango.Layout(ctx)
+            layout.set_markup(" ") # assumes monospace
+            self.cell_size = layout.get_pixel_size()
+
+        return self.cell_size
+
+    def reset_cell_size(self, *args):
+        self.cell_size = None
 
     def get_tag_for(self, ev_data):
         """
@@ -215,30 +266,93 @@ class Terminal(Gtk.Window):
 
         return tag
 
-    def handle_pty(self, source, tag, master):
-        cond = source.query_unix_fd(tag)
+    def prewarm_text_tags(self):
+        # Create TextTags for commonly used styles (e.g. by ls(1)) ahead
+        # of time to avoid creating them while handling PTY output.
+        styles = [
+            (pty.TextStyleChange.WEIGHT, Pango.Weight.BOLD),
+            (pty.TextStyleChange.ITALIC, True),
+            (pty.TextStyleChange.UNDERLINE, Pango.Underline.SINGLE),
+        ]
+
+        for t in (ColorType.NUMBERED_8, ColorType.NUMBERED_8_BRIGHT):
+            for c in BasicColor:
+                color = Color(t, c)
+                styles.append((pty.TextStyleChange.FOREGROUND_COLOR, color))
+                styles.append((pty.TextStyleChange.BACKGROUND_COLOR, color))
+
+        for style in styles:
+            self.get_tag_for(style)
+
+        return GLib.SOURCE_REMOVE
+
+    def handle_pty(self, master, cond):
         if cond & GLib.IOCondition.HUP:
             Gtk.main_quit()
             return GLib.SOURCE_REMOVE
 
-        data = os.read(master, 4096)
+        # Drain the PTY to reduce the amount of main loop iterations
+        # (and thus parser invocations) required for bulk output.
+        data = bytearray()
+        deadline = time.monotonic() + READ_TIME
+        while True:
+            try:
+                n = os.readv(master, [self.read_buffer])
+            except BlockingIOError:
+                break
+            except OSError as e:
+                # The child may exit while we are draining the PTY,
+                # this is detected via HUP on the next invocation.
+                if e.errno != errno.EIO or not data:
+                    raise
+                break
+
+            if n == 0:
+                break
+            data += self.read_buffer[:n]
+
+            # Limits are checked after reading to ensure that at
+            # least one read is performed on each invocation.
+            if len(data) >= READ_LIMIT or time.monotonic() >= deadline:
+                break
+
+        # The PTY may have been readable without any data remaining
+        # when reading, in which case we wait for the next wakeup.
         if not data:
-            raise AssertionError("expected data but did not receive any")
+            return GLib.SOURCE_CONTINUE
+
+        # Output indicates that the child may have changed
+        # the termios settings, invalidate cached settings.
+        self.pty.invalidate_cc()
 
         decoded = self.decoder.decode(data)
 
+        # Consecutive TEXT events are joined and added to the batch
+        # of text inserted into the TermView at once. Hence, pending
+        # text needs to be added when the active text tags change.
+        pending = []
+        batch = []
+        # Multiple bells are only signaled once per invocation.
+        bell = False
+
+        # avoid repeated attribute lookups in the loop below
+        TEXT = pty.EventType.TEXT
+        BELL = pty.EventType.BELL
+        TEXT_STYLE = pty.EventType.TEXT_STYLE
+        RESET = pty.TextStyleChange.RESET
+
         for (ev, data) in self.pty_parser.parse(decoded):
-            if ev is pty.EventType.TEXT:
-                self.termview.insert_data(data, *self.active_text_tags.values())
-            elif ev is pty.EventType.BELL:
-                self.termview.error_bell()
-                self.set_urgency_hint(True)
-            elif ev is pty.EventType.TEXT_STYLE:
+            if ev is TEXT:
+                pending.append(data)
+            elif ev is BELL:
+                bell = True
+            elif ev is TEXT_STYLE:
                 (change, _) = data
+                tags = self.text_tags
 
-                if change is pty.TextStyleChange.RESET:
+                if change is RESET:
                     # On RESET we just use the default style of the TermView
-                    self.active_text_tags = {}
+                    self.reset_text_tags()
                 else:
                     # To avoid creating an unnecessary amount of TextTags,
                     # we let get_tag_for create and cache TextTags.
@@ -247,22 +361,43 @@ class Terminal(Gtk.Window):
                     # Instead of a single tag which has the exact attributes
                     # we need, we apply multiple tags which makes the tags
                     # more cacheable. We track the currently active tags in
-                    # a dict mapping from TextStyleChanges to TextTags.
-                    # Since all tags associated with the same TextStyleChange
+                    # a list indexed by the TextStyleChange's value. Since
+                    # all tags associated with the same TextStyleChange
                     # are mutually exclusive, we get the correct state updates
                     # for free. In cases where the default style of TermView
-                    # is appropriate, get_tag_for() returns None and we delete
-                    # the respective entry from the dict.
-                    if new_tag is None:
-                        if change in self.active_text_tags:
-                            del self.active_text_tags[change]
-                    else:
-                        self.active_text_tags[change] = new_tag
+                    # is appropriate, get_tag_for() returns None which
+                    # clears the respective entry of the list.
+                    self.active_text_tags[change.value] = new_tag
+                    self.update_text_tags()
+
+                # Escape sequences frequently don't change the active
+                # tags (e.g. resetting an already reset style). Only
+                # start a new run in the batch if the tags did change.
+                if pending and self.text_tags != tags:
+                    batch.append(("".join(pending), tags))
+                    pending = []
             else:
                 raise AssertionError("unknown pty.EventType")
 
+        if pending:
+            batch.append(("".join(pending), self.text_tags))
+        if batch:
+            self.termview.insert_batch(batch)
+        if bell:
+            self.termview.error_bell()
+            self.set_urgency_hint(True)
+
         return GLib.SOURCE_CONTINUE
 
+    def reset_text_tags(self):
+        # TextStyleChange values start at 1, the first slot is unused
+        self.active_text_tags = [None] * (len(pty.TextStyleChange) + 1)
+        self.text_tags = ()
+
+    def update_text_tags(self):
+        # Tags passed to insert_batch(), only rebuild on style changes.
+        self.text_tags = tuple(t for t in self.active_text_tags if t is not None)
+
     def toggle_search(self, termview, search_bar):
         active = search_bar.get_search_mode()
         search_bar.set_search_mode(not active)
@@ -292,21 +427,34 @@ class Terminal(Gtk.Window):
         self.termview.emit("kill-after-output")
         self.termview.emit("insert-at-cursor", entry)
 
-    def autoscroll(self, widget, rect):
-        if not self.config['autoscroll']:
+    def autoscroll(self, adj, pspec):
+        if not self.config['autoscroll'] or self.autoscroll_pending:
             return
 
+        # Multiple size allocations (e.g. during bulk output) are
+        # coalesced by adjusting the scroll position when idle.
+        self.autoscroll_pending = True
+        GLib.idle_add(self.scroll_to_end, priority=GLib.PRIORITY_DEFAULT_IDLE)
+
+    def scroll_to_end(self):
+        self.autoscroll_pending = False
+
         # For some reason it is not possible to use .scroll_to_mark()
         # et cetera on the TextView contained in the ScrolledWindow.
         adj = self.scroll.get_vadjustment()
         adj.set_value(adj.get_upper() - adj.get_page_size())
 
+        return GLib.SOURCE_REMOVE
+
     def toggle_config(self, widget, key):
         self.config[key] = not self.config[key]
         if key == 'wordwrap':
             self.update_wrapmode()
 
     def populate_popup(self, textview, popup):
+        # The TextView destroys the previous popup, including all items
+        # appended here, before populating a new one. Hence, the items
+        # need to be recreated every time and can't be reused.
         popup.append(Gtk.SeparatorMenuItem())
         for key, enabled in self.config.items():
             mitem = Gtk.CheckMenuItem(key.capitalize())
@@ -317,11 +465,24 @@ class Terminal(Gtk.Window):
 
         popup.show_all()
 
+    def commit_history(self):
+        self.hist_commit_pending = False
+        self.hist.commit()
+
+        return GLib.SOURCE_REMOVE
+
     def user_input(self, termview, line):
         self.hist.add_entry(self.pty.master, line)
+        # Write history entries to the database when idle
+        if not self.hist_commit_pending:
+            self.hist_commit_pending = True
+            GLib.idle_add(self.commit_history, priority=GLib.PRIORITY_LOW)
         self.reset_history_index()
+        self.pty.invalidate_cc()
+        self.file_completion = None
 
-        os.write(self.pty.master, line.encode("UTF-8"))
+        # str.encode() defaults to UTF-8 and skips the codec lookup
+        self.pty.write(line.encode())
 
     def termios_ctrl(self, termview, cidx):
         # termios ctrl keys are ignored if the cursor is not at the
@@ -331,9 +492,11 @@ class Terminal(Gtk.Window):
         elif cidx == termios.VEOF:
             termview.flush()
 
-        # TODO: Employ some heuristic to cache tcgetattr result.
-        cc = termios.tcgetattr(self.pty.master)[-1]
-        os.write(self.pty.master, cc[cidx])
+        # The control characters are only retrieved using tcgetattr
+        # if the child produced output or received input since the
+        # last invocation, otherwise the settings can't have changed.
+        cc = self.pty.control_chars()
+        self.pty.write(cc[cidx])
 
         # XXX: Clear line-based buffer here (i.e. update the
         # marks in TermView) in case the application doesn't
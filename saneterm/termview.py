@@ -1,26 +1,51 @@
+import re
+
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
+from gi.repository import GLib
 
 from . import completion
 
+# matches the word to be completed at the start of the reversed input,
+# searching for it at the end of the input instead would be quadratic
+COMPLETION_WORD = re.compile(r'\S*')
+
 class TermBuffer(Gtk.TextBuffer):
     """
     Buffer which stores a limit amount of lines. If the limit is -1
     an unlimited amount of lines is stored. Old lines are deleted
-    automatically if the limit is exceeded. Furthermore, the buffer
-    provides some facilities for more native copy/paste handling.
+    automatically, in blocks, once the limit is exceeded by a small
+    fraction of it. Furthermore, the buffer provides some facilities
+    for more native copy/paste handling.
     """
 
     def __init__(self, limit):
         Gtk.TextBuffer.__init__(self)
         self._clipboard = Gtk.Clipboard.get(Gdk.SELECTION_PRIMARY)
+        self._clipboard_pending = False
 
         if limit == -1:
             return # unlimited
 
         self.limit = limit
+        # Amount of lines by which the limit must be exceeded before
+        # old lines are deleted. Deleting lines in larger blocks
+        # amortizes the cost of the deletion across many inserts.
+        self._overrun = max(1, limit // 16)
+        # Upper bound for the amount of lines in the buffer, maintained
+        # incrementally on insertion and deletion. Gtk terminates lines
+        # on \n, \r, \r\n and U+2029, each of these characters is
+        # counted on insertion (thus \r\n twice), the exact amount is
+        # determined using get_line_count() before deleting lines.
+        self._lines = 1
+        # Whether a user action (e.g. pasting text) is in progress.
+        self._user_action = False
+
+        self.connect("begin-user-action", self.__begin_user_action)
+        self.connect("end-user-action", self.__end_user_action)
         self.connect_after("insert-text", self.__insert_text)
+        self.connect("delete-range", self.__delete_range)
 
     def do_mark_set(self, loc, mark):
         # Gtk only partially adheres to the freedesktop.org clipboard
@@ -31,29 +56,65 @@ class TermBuffer(Gtk.TextBuffer):
         # dirty workaround for this bug.
         #
         # See https://gitlab.gnome.org/GNOME/gtk/-/issues/317
+        #
+        # Marks are set frequently (e.g. while output is inserted),
+        # copying the selection to the clipboard is thus deferred until
+        # the main loop is idle.
+
+        if self.get_selection_bounds():
+            if not self._clipboard_pending:
+                self._clipboard_pending = True
+                GLib.idle_add(self.__update_clipboard)
+        else:
+            Gtk.TextBuffer.do_mark_set(self, loc, mark)
+
+    def __update_clipboard(self):
+        self._clipboard_pending = False
 
         selection = self.get_selection_bounds()
         if selection:
             start, end = selection
             text = self.get_text(start, end, True)
             self._clipboard.set_text(text, -1)
-        else:
-            Gtk.TextBuffer.do_mark_set(self, loc, mark)
+
+        return GLib.SOURCE_REMOVE
+
+    def __begin_user_action(self, buffer):
+        # A single user action may insert text multiple times, trimming
+        # is deferred until the action finished to only perform it once.
+        self._user_action = True
+
+    def __end_user_action(self, buffer):
+        self._user_action = False
+        if self._lines - self.limit >= self._overrun:
+            self.__trim()
 
     def __insert_text(self, buffer, loc, text, len):
-        lines = buffer.get_line_count()
-        diff = lines - self.limit
-        if diff <= 0:
+        self._lines += text.count("\n") + text.count("\r") + text.count("\u2029")
+        if self._user_action or self._lines - self.limit < self._overrun:
             return
 
-        end = buffer.get_start_iter()
+        if self.__trim():
+            # Revalide the given iterator
+            loc.assign(buffer.get_end_iter())
+
+    def __delete_range(self, buffer, start, end):
+        # Iterators are still valid before the default handler ran.
+        self._lines -= end.get_line() - start.get_line()
+
+    def __trim(self):
+        self._lines = self.get_line_count()
+        diff = self._lines - self.limit
+        if diff < self._overrun:
+            return False
+
+        end = self.get_start_iter()
         end.forward_lines(diff)
 
-        start = buffer.get_start_iter()
-        buffer.delete(start, end)
+        start = self.get_start_iter()
+        self.delete(start, end) # updates self._lines
 
-        # Revalide the given iterator
-        loc.assign(buffer.get_end_iter())
+        return True
 
 class TermView(Gtk.TextView):
     """
@@ -66,6 +127,7 @@ class TermView(Gtk.TextView):
     character. Afterwards, a new-user-input signal is emitted to which
     the application should connect. To display input received from the
     backend source (e.g. a PTY) the insert_data method should be used.
+    Multiple chunks of data can be inserted at once using insert_batch.
 
     Internally, the widget tracks input through two markers. The
     _last_output_mark tracks the position in the underlying TextView
@@ -78,6 +140,37 @@ class TermView(Gtk.TextView):
     to the application via the termios-ctrlkey signal.
     """
 
+    # Signals are registered once for the class instead of per instance.
+    # Signals implemented by the widget itself are handled by the
+    # corresponding do_* methods, which act as class closures. These
+    # are only invoked for signals with a RUN_* flag, hence RUN_LAST.
+    __gsignals__ = {
+        "kill-after-output": (GObject.SIGNAL_RUN_LAST | GObject.SIGNAL_ACTION,
+                GObject.TYPE_NONE, ()),
+        "move-input-start": (GObject.SIGNAL_RUN_LAST | GObject.SIGNAL_ACTION,
+                GObject.TYPE_NONE, ()),
+        "move-input-end": (GObject.SIGNAL_RUN_LAST | GObject.SIGNAL_ACTION,
+                GObject.TYPE_NONE, ()),
+        "clear-view": (GObject.SIGNAL_RUN_LAST | GObject.SIGNAL_ACTION,
+                GObject.TYPE_NONE, ()),
+        "tab-completion": (GObject.SIGNAL_RUN_LAST | GObject.SIGNAL_ACTION,
+                GObject.TYPE_NONE, ()),
+        "paste-primary": (GObject.SIGNAL_RUN_LAST | GObject.SIGNAL_ACTION,
+                GObject.TYPE_NONE, ()),
+
+        "termios-ctrlkey": (GObject.SIGNAL_ACTION, GObject.TYPE_NONE,
+                (GObject.TYPE_LONG,)),
+        "new-user-input": (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
+                (GObject.TYPE_PYOBJECT,)),
+
+        # Key binding signals which must be handled by the application
+        "toggle-search": (GObject.SIGNAL_ACTION, GObject.TYPE_NONE, ()),
+        "toggle-config": (GObject.SIGNAL_ACTION, GObject.TYPE_NONE,
+                (GObject.TYPE_STRING,)),
+        "history-entry": (GObject.SIGNAL_ACTION, GObject.TYPE_NONE,
+                (GObject.TYPE_LONG,)),
+    }
+
     def __init__(self, compfunc, limit=-1):
         # TODO: set insert-hypens to false in GTK 4
         # https://docs.gtk.org/gtk4/property.TextTag.insert-hyphens.html
@@ -93,40 +186,33 @@ class TermView(Gtk.TextView):
         self.set_monospace(True)
         self.set_input_hints(Gtk.InputHints.NO_SPELLCHECK | Gtk.InputHints.EMOJI)
 
-        self._last_mark = self._textbuffer.create_mark(None,
-                self._textbuffer.get_end_iter(), True)
-        self._last_output_mark = self._last_mark
-
-        signals = {
-            "kill-after-output": self.__kill_after_output,
-            "move-input-start": self.__move_input_start,
-            "move-input-end": self.__move_input_end,
-            "clear-view": self.__clear_view,
-            "tab-completion": self.__tabcomp,
-            "paste-primary": self.__paste_primary,
-        }
-
-        for name, func in signals.items():
-            GObject.signal_new(name, self,
-                    GObject.SIGNAL_ACTION, GObject.TYPE_NONE,
-                    ())
-
-            self.connect(name, func)
-
-        GObject.signal_new("termios-ctrlkey", self,
-                GObject.SIGNAL_ACTION, GObject.TYPE_NONE,
-                (GObject.TYPE_LONG,))
-
-        GObject.signal_new("new-user-input", self,
-                GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
-                (GObject.TYPE_PYOBJECT,))
+        end = self._textbuffer.get_end_iter()
+        self._last_mark = self._textbuffer.create_mark(None, end, True)
+        self._last_output_mark = self._textbuffer.create_mark(None, end, True)
 
     def insert_data(self, str, *tags):
-        self._textbuffer.insert_with_tags(self._textbuffer.get_end_iter(), str, *tags)
+        self.insert_batch(((str, tags),))
 
-        end = self._textbuffer.get_end_iter()
-        self._last_mark = self._textbuffer.create_mark(None, end, True)
-        self._last_output_mark = self._last_mark
+    def insert_batch(self, batch):
+        # Inserts a sequence of (str, tags) tuples, as accepted by
+        # insert_data, and only updates the marks once afterwards.
+        buf = self._textbuffer
+
+        # The iterator is revalidated by insert_with_tags (and by
+        # TermBuffer when trimming) to point to the end of the inserted
+        # text and can thus be reused for the entire batch.
+        end = buf.get_end_iter()
+        for str, tags in batch:
+            # Most output is untagged, insert_with_tags would
+            # needlessly determine the offset of the iterator.
+            if tags:
+                buf.insert_with_tags(end, str, *tags)
+            else:
+                buf.insert(end, str)
+
+        # Move existing marks instead of allocating new ones
+        buf.move_mark(self._last_mark, end)
+        buf.move_mark(self._last_output_mark, end)
 
     def flush(self):
         end = self._textbuffer.get_end_iter()
@@ -136,17 +222,16 @@ class TermView(Gtk.TextView):
 
         self.emit("new-user-input", line)
 
-        self._last_output_mark = self._textbuffer.create_mark(None, end, True)
-        self._last_mark = self._last_mark
+        self._textbuffer.move_mark(self._last_output_mark, end)
 
     def __cursor_at_mark(self, mark):
-        if self._textbuffer.get_has_selection():
+        buf = self._textbuffer
+        if buf.get_has_selection():
             return False
 
-        cur = self._textbuffer.get_iter_at_offset(self._textbuffer.props.cursor_position)
-        other = self._textbuffer.get_iter_at_mark(mark)
-
-        return cur.compare(other) == 0
+        # Compare offsets, avoids creating an iterator for the cursor
+        other = buf.get_iter_at_mark(mark)
+        return buf.props.cursor_position == other.get_offset()
 
     def cursor_at_out(self):
         return self.__cursor_at_mark(self._last_output_mark)
@@ -163,10 +248,12 @@ class TermView(Gtk.TextView):
         start = buffer.get_iter_at_mark(self._last_mark)
         end = self._textbuffer.get_end_iter()
 
-        text = buffer.get_text(start, end, True)
-        if len(text) != 0 and text[-1] == "\n":
+        # Only inspect the last character instead of retrieving all
+        # text entered since the last user action from the buffer.
+        last = end.copy()
+        if start.compare(end) < 0 and last.backward_char() and last.get_char() == "\n":
             self.flush()
-        self._last_mark = buffer.create_mark(None, end, True)
+        buffer.move_mark(self._last_mark, end)
 
         # User entered new text → reset tab completion state machine
         self._tabcomp.reset()
@@ -179,7 +266,7 @@ class TermView(Gtk.TextView):
             return Gtk.TextView.do_delete_from_cursor(self, type, count)
 
         buf = self._textbuffer
-        cur = buf.get_iter_at_offset(buf.props.cursor_position)
+        cur = buf.get_iter_at_mark(buf.get_insert())
         out = buf.get_iter_at_mark(self._last_output_mark)
 
         # Only go backward by $count if there are enough characters
@@ -188,7 +275,7 @@ class TermView(Gtk.TextView):
         tgt = Gtk.TextIter.copy(cur)
         if not tgt.backward_word_starts(0 - count):
             return
-        elif tgt.compare(out) != 1: # tgt <= out
+        elif tgt.get_offset() <= out.get_offset():
             # XXX: For some reason adjusting counting and changing the
             # type to Gtk.DeleteType.CHARS does not work → delete directly.
             self._textbuffer.delete_interactive(out, cur, True)
@@ -196,53 +283,55 @@ class TermView(Gtk.TextView):
 
         Gtk.TextView.do_delete_from_cursor(self, type, count)
 
-    def __kill_after_output(self, textview):
-        buffer = textview.get_buffer()
+    def do_kill_after_output(self):
+        buffer = self._textbuffer
 
         start = buffer.get_iter_at_mark(self._last_output_mark)
         end = buffer.get_end_iter()
 
-        buffer.delete(start, end)
+        # Avoid emitting delete-range if there is no input
+        if not start.equal(end):
+            buffer.delete(start, end)
 
-    def __move_input_start(self, textview):
-        buffer = textview.get_buffer()
+    def do_move_input_start(self):
+        buffer = self._textbuffer
 
         start = buffer.get_iter_at_mark(self._last_output_mark)
         buffer.place_cursor(start)
 
-    def __move_input_end(self, textview):
-        buffer = textview.get_buffer()
+    def do_move_input_end(self):
+        buffer = self._textbuffer
 
         end = buffer.get_iter_at_mark(self._last_mark)
         buffer.place_cursor(end)
 
-    def __clear_view(self, textview):
-        buffer = textview.get_buffer()
+    def do_clear_view(self):
+        buffer = self._textbuffer
 
         # XXX: This function breaks with multi-line prompts, etc.
         end = buffer.get_iter_at_mark(self._last_output_mark)
-        off = end.get_visible_line_offset()
-        end.backward_chars(off)
-
-        buffer.delete(buffer.get_start_iter(), end)
-
-    def __tabcomp(self, textview):
-        buf = textview.get_buffer()
-        cur = buf.get_iter_at_offset(buf.props.cursor_position)
+        end.set_line_offset(0)
 
-        # Gtk.TextCharPredicate to find start of word to be completed.
-        fn = lambda x, _: str.isspace(x)
+        # Avoid emitting delete-range if the view is already clear
+        if not end.is_start():
+            buffer.delete(buffer.get_start_iter(), end)
 
+    def do_tab_completion(self):
+        buf = self._textbuffer
+        cur = buf.get_iter_at_mark(buf.get_insert())
         out = buf.get_iter_at_mark(self._last_output_mark)
-        if cur.backward_find_char(fn, None, out):
-            cur.forward_char()
-        else:
-            cur.assign(out)
 
-        self._tabcomp.next(cur)
+        # Find start of word to be completed in the text before the
+        # cursor instead of invoking a Gtk.TextCharPredicate per char.
+        if cur.compare(out) > 0:
+            text = buf.get_text(out, cur, True)
+            word = COMPLETION_WORD.match(text[::-1]).end()
+            out.forward_chars(len(text) - word)
+
+        self._tabcomp.next(out)
 
     # See https://gitlab.gnome.org/GNOME/gtk/-/issues/352
-    def __paste_primary(self, textview):
-        buf = textview.get_buffer()
+    def do_paste_primary(self):
+        buf = self._textbuffer
         buf.paste_clipboard(self._clipboard, None,
-            textview.props.editable)
+            self.props.editable)
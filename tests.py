@@ -2,26 +2,28 @@
 import unittest
 
 from saneterm.color import Color, ColorType
-from saneterm.pty import PositionedIterator
-
-from gi.repository import Gdk
+from saneterm.pty import PositionedIterator, Decoder, Parser, EventType, TextStyleChange
 
 TEST_STRING = 'foo;bar'
+LONG_TEST_STRING = 'a' * 10000 + ';' + 'b' * 10000
 
 class TestPositionedIterator(unittest.TestCase):
     """Tests for saneterm.pty.PositionedIterator"""
 
+    def setUp(self):
+        self.it = PositionedIterator(TEST_STRING)
+
     def test_lossless(self):
         """Test that the iterator doesn't loose any content"""
 
-        it = PositionedIterator(TEST_STRING)
+        it = self.it
 
         self.assertEqual([x for x in it], list(TEST_STRING))
         self.assertEqual(it.wrapped, TEST_STRING)
 
     def test_indices(self):
         """Test that the iterator's pos matches the string indices"""
-        it = PositionedIterator(TEST_STRING)
+        it = self.it
 
         self.assertEqual(it.pos, -1)
 
@@ -40,7 +42,7 @@ class TestPositionedIterator(unittest.TestCase):
 
     def test_backtracking(self):
         """Test waypoint() and backtrack() methods"""
-        it = PositionedIterator(TEST_STRING)
+        it = self.it
 
         semicolon_index = None
 
@@ -63,7 +65,7 @@ class TestPositionedIterator(unittest.TestCase):
 
     def test_takewhile_greedy(self):
         """Test takewhile_greedy() method"""
-        it = PositionedIterator(TEST_STRING)
+        it = self.it
 
         s = it.takewhile_greedy(lambda x: x != ';')
 
@@ -71,9 +73,33 @@ class TestPositionedIterator(unittest.TestCase):
         self.assertEqual(it.pos, len(s) - 1)
         self.assertEqual(it.next(), ';')
 
+    def test_takewhile_greedy_unterminated(self):
+        """Test takewhile_greedy() consuming the entire input"""
+        it = self.it
+
+        with self.assertRaises(StopIteration):
+            _ = it.takewhile_greedy(lambda x: x != '!')
+
+        self.assertTrue(it.empty())
+
+    def test_take_until(self):
+        """Test take_until() method"""
+        it = self.it
+
+        s = it.take_until('!;')
+
+        self.assertEqual(s, TEST_STRING.split(';')[0])
+        self.assertEqual(it.pos, len(s) - 1)
+        self.assertEqual(it.next(), ';')
+
+        with self.assertRaises(StopIteration):
+            _ = it.take_until(';')
+
+        self.assertTrue(it.empty())
+
     def test_empty(self):
         """Test empty() predicate"""
-        it = PositionedIterator(TEST_STRING)
+        it = self.it
 
         for x in it:
             if it.pos + 1 == len(TEST_STRING):
@@ -91,19 +117,136 @@ class TestPositionedIterator(unittest.TestCase):
         it2 = PositionedIterator(TEST_STRING)
 
         s1 = it1.take(length)
-        s2 = ''
+        s2 = []
         for x in it2:
             if it2.pos >= length:
                 break
             else:
-                s2 += x
+                s2.append(x)
 
-        self.assertEqual(s1, s2)
+        self.assertEqual(s1, ''.join(s2))
         self.assertEqual(s1, TEST_STRING[0:length])
 
         # using take does not consume the next element!
         self.assertEqual(it1.pos, length - 1)
 
+    def test_take_exceeding(self):
+        """Test take() with more elements than available"""
+        it = self.it
+
+        with self.assertRaises(StopIteration):
+            _ = it.take(len(TEST_STRING) + 1)
+
+        self.assertTrue(it.empty())
+
+    def test_reset(self):
+        """Test that reset() allows reusing the iterator"""
+        it = self.it
+
+        for x in it:
+            if x == ';':
+                it.waypoint()
+
+        it.reset(LONG_TEST_STRING)
+        self.assertEqual(it.pos, -1)
+        self.assertEqual(it.wrapped, LONG_TEST_STRING)
+        self.assertEqual([x for x in it], list(LONG_TEST_STRING))
+
+        # waypoints set before reset() are discarded
+        with self.assertRaises(IndexError):
+            it.backtrack()
+
+    def test_long_input(self):
+        """Test take_until() and take() on short and long input"""
+        for s in (TEST_STRING, LONG_TEST_STRING):
+            with self.subTest(length=len(s)):
+                it = self.it
+                it.reset(s)
+
+                head = it.take_until(';')
+                self.assertEqual(head, s.split(';')[0])
+                self.assertEqual(it.next(), ';')
+
+                tail = it.take(len(s) - it.pos - 1)
+                self.assertEqual(head + ';' + tail, s)
+                self.assertTrue(it.empty())
+
+class TestParser(unittest.TestCase):
+    """Tests for saneterm.pty.Parser"""
+
+    def test_text(self):
+        """Test that ordinary text is emitted as a single TEXT event"""
+        p = Parser()
+        self.assertEqual(list(p.parse(TEST_STRING)), [(EventType.TEXT, TEST_STRING)])
+
+    def test_control_chars(self):
+        """Test that control characters split TEXT events"""
+        p = Parser()
+        self.assertEqual(list(p.parse('foo\abar\033[Kbaz')), [
+            (EventType.TEXT, 'foo'),
+            (EventType.BELL, None),
+            (EventType.TEXT, 'bar'),
+            (EventType.TEXT, 'baz'),
+        ])
+
+    def test_unsupported_esc(self):
+        """Test that unsupported escape sequences are rendered verbatim"""
+        p = Parser()
+        self.assertEqual(list(p.parse('foo\033]bar')), [
+            (EventType.TEXT, 'foo'),
+            (EventType.TEXT, '\033]bar'),
+        ])
+
+    def test_leftover(self):
+        """Test that incomplete escape sequences are parsed on the next call"""
+        p = Parser()
+        self.assertEqual(list(p.parse('foo\033[')), [(EventType.TEXT, 'foo')])
+        self.assertEqual(list(p.parse('Kbar')), [(EventType.TEXT, 'bar')])
+
+    def test_sgr(self):
+        """Test that SGR sequences generate TEXT_STYLE events"""
+        p = Parser()
+        events = p.parse('foo\033[1mbar\033[0m')
+
+        self.assertEqual([ev for (ev, _) in events], [
+            EventType.TEXT,
+            EventType.TEXT_STYLE,
+            EventType.TEXT,
+            EventType.TEXT_STYLE,
+        ])
+        self.assertEqual(events[1][1][0], TextStyleChange.WEIGHT)
+        self.assertEqual(events[3][1], (TextStyleChange.RESET, None))
+
+class TestDecoder(unittest.TestCase):
+    """Tests for saneterm.pty.Decoder"""
+
+    def test_ascii(self):
+        """Test that ASCII input is decoded as is"""
+        dec = Decoder()
+        self.assertEqual(dec.decode(TEST_STRING.encode()), TEST_STRING)
+
+    def test_split_sequence(self):
+        """Test decoding of multi-byte sequences split across calls"""
+        expected = 'foo ✓ bar'
+        data = expected.encode('UTF-8')
+
+        for n in range(len(data) + 1):
+            dec = Decoder()
+            self.assertEqual(dec.decode(data[:n]) + dec.decode(data[n:]), expected)
+
+    def test_invalid(self):
+        """Test that invalid input is decoded using replacement characters"""
+        dec = Decoder()
+        self.assertEqual(dec.decode(b'foo\xffbar'), 'foo\ufffdbar')
+        self.assertEqual(dec.decode(b'\xe2\x9c'), '')
+        self.assertEqual(dec.decode(b'foo'), '\ufffdfoo')
+
+    def test_invalid_incomplete(self):
+        """Test that invalid incomplete sequences are not retained"""
+        dec = Decoder()
+        self.assertEqual(dec.decode(b'\xf4\xa0'), '\ufffd\ufffd')
+        self.assertEqual(dec.decode(b'\xe0\x80'), '\ufffd\ufffd')
+
 class TestColor(unittest.TestCase):
     """Tests for saneterm.color"""
 
@@ -121,15 +264,10 @@ class TestColor(unittest.TestCase):
                 for b in range(6):
                     n = 16 + (r * 36) + (g * 6) + b
 
-                    expected = Gdk.RGBA(*map(channel_val, (r, g, b)))
-                    col = Color(ColorType.NUMBERED_256, n).to_gdk()
+                    expected = (*map(channel_val, (r, g, b)), 1.0)
+                    col = Color(ColorType.NUMBERED_256, n).to_rgba_tuple()
 
-                    self.assertTrue(
-                        expected.equal(col),
-                        'Color {}: expected: {}; got: {}'.format(
-                            n, expected.to_string(), col.to_string()
-                        )
-                    )
+                    self.assertEqual(expected, col, 'Color {}'.format(n))
 
 if __name__ == '__main__':
     unittest.main()